@@ -1,41 +1,117 @@
 import streamlit as st
-import json
-import time
-from io import StringIO
-from pypdf import PdfReader
+from json_utils import loads
+import copy
+import uuid
+import asyncio
+from collections import OrderedDict
+from io import StringIO, BytesIO
 import pandas as pd
 
 # --- Local Imports ---
-from crew_logic import analyze_initial_request, refine_requirements_with_answer, finalize_requirements_document
 from dashboard_utils import get_dashboard_data
+import persistence
+
+def _crew_logic():
+    # crewai and litellm take seconds to import; defer them until the first LLM call instead of every rerun.
+    import crew_logic
+    return crew_logic
 
 # --- Page Setup ---
 st.set_page_config(page_title="AI Requirements Assistant", layout="wide")
 
 # --- Session State Initialization ---
+# Older chats fall off the end of the session history once this many exist.
+MAX_CHAT_HISTORY = 50
+RECENT_CHATS_IN_SIDEBAR = 10
+
+SESSION_DEFAULTS = {
+    "page": "Chatbot",
+    # Keyed by chat id, most recently active first.
+    "chat_history": OrderedDict(),
+    "current_chat_id": None,
+    "stage": "initial",
+    "messages": [],
+    "requirements": [],
+    "clarification_questions": [],
+    "question_index": 0,
+    "collected_answers": [],
+    "scores": {},
+    "final_doc": None,
+    "persisted_messages": 0,
+    # Set by handlers that change the current chat; the chat is saved once per run, not per change.
+    "dirty": False,
+}
+
+def _workspace_id():
+    # Saved projects belong to a workspace whose id lives in the URL, so a refresh or a bookmark finds them again
+    # while other visitors (who get their own id) never see them.
+    workspace_id = st.query_params.get("workspace", "")
+    if not persistence.is_valid_workspace_id(workspace_id):
+        workspace_id = uuid.uuid4().hex
+        st.query_params["workspace"] = workspace_id
+    return workspace_id
+
+def _restore_from_disk():
+    try:
+        chats = persistence.load_sessions(st.session_state.workspace_id, limit=MAX_CHAT_HISTORY)
+    except OSError as e:
+        st.warning(f"Couldn't load saved projects: {e}")
+        chats = []
+    st.session_state.chat_history = OrderedDict((chat['id'], chat) for chat in chats)
+
 def init_session_state():
-    if "page" not in st.session_state:
-        st.session_state.page = "Chatbot"
-    if "chat_history" not in st.session_state:
-        st.session_state.chat_history = []
-    if "current_chat_id" not in st.session_state: st.session_state.current_chat_id = None
-    if "stage" not in st.session_state: st.session_state.stage = "initial"
-    if "messages" not in st.session_state: st.session_state.messages = []
-    if "requirements" not in st.session_state: st.session_state.requirements = []
-    if "clarification_questions" not in st.session_state: st.session_state.clarification_questions = []
-    if "question_index" not in st.session_state: st.session_state.question_index = 0
-    if "scores" not in st.session_state: st.session_state.scores = {}
-    if "final_doc" not in st.session_state: st.session_state.final_doc = None
+    session_state = st.session_state
+    # A fresh browser session (refresh or restart) picks up the workspace's previously saved projects.
+    if "chat_history" not in session_state:
+        session_state.workspace_id = _workspace_id()
+        _restore_from_disk()
+    for key, default in SESSION_DEFAULTS.items():
+        if key not in session_state:
+            # Copy so sessions never share the module-level list/dict defaults.
+            session_state[key] = copy.copy(default)
 
 init_session_state()
 
 
+# --- Document Parsing ---
+
+# Uploaded documents beyond this size would not fit the model's context anyway.
+MAX_DOCUMENT_CHARS = 200_000
+
+# Bounds the cache to a few recent uploads (at most ~200 KB of text each) for an hour.
+@st.cache_data(max_entries=16, ttl=3600, show_spinner=False)
+def extract_pdf_text(pdf_bytes):
+    from pypdf import PdfReader
+    # Pages are extracted one at a time and extraction stops once the character budget is spent.
+    reader = PdfReader(BytesIO(pdf_bytes))
+    texts, total_chars = [], 0
+    for page in reader.pages:
+        text = page.extract_text() or ""
+        texts.append(text)
+        total_chars += len(text)
+        if total_chars >= MAX_DOCUMENT_CHARS:
+            break
+    return "".join(texts)[:MAX_DOCUMENT_CHARS]
+
 # --- UI Rendering Functions ---
 
+@st.cache_data(ttl=60, show_spinner=False)
+def load_dashboard_data(history_snapshot):
+    # The snapshot holds only what the dashboard reads, so unrelated reruns hit the cache.
+    chats = [
+        {'id': chat_id, 'title': title, 'requirements': list(requirements), 'prioritization_scores': dict(scores)}
+        for chat_id, title, requirements, scores in history_snapshot
+    ]
+    return get_dashboard_data(chats)
+
 def show_dashboard_page():
     st.title("Project Dashboard")
-    st.info("This dashboard provides an overview of all projects created in your current session.")
-    dashboard_data = get_dashboard_data(st.session_state.chat_history)
+    st.info("This dashboard provides an overview of all projects in this workspace. Bookmark this page's URL to come back to them.")
+    history_snapshot = tuple(
+        (chat['id'], chat['title'], tuple(chat.get('requirements', [])), tuple(sorted(chat.get('prioritization_scores', {}).items())))
+        for chat in st.session_state.chat_history.values()
+    )
+    dashboard_data = load_dashboard_data(history_snapshot)
 
     col1, col2, col3 = st.columns(3)
     col1.metric("Total Projects", dashboard_data["total_projects"])
@@ -51,7 +127,7 @@ def show_dashboard_page():
         else:
             st.info("Complete a project to see priority stats.")
     with col2:
-        st.subheader("Recent Projects (This Session)")
+        st.subheader("Recent Projects (This Workspace)")
         if not dashboard_data["recent_projects"]:
             st.info("No projects started yet. Go to the 'Chatbot' page to create one.")
         else:
@@ -65,12 +141,15 @@ def show_dashboard_page():
                         st.session_state.page = "Chatbot"
                         st.rerun()
 
-def show_chatbot_page():
-    st.title("🤖 AI Requirements Assistant")
+def _render_messages():
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
 
+def show_chatbot_page():
+    st.title("🤖 AI Requirements Assistant")
+    _render_messages()
+
     if st.session_state.stage == "initial":
         with st.form("initial_request_form"):
             user_text = st.text_area("Describe your project or feature:", height=150)
@@ -80,8 +159,7 @@ def show_chatbot_page():
                 if uploaded_file:
                     try:
                         if uploaded_file.type == "application/pdf":
-                            reader = PdfReader(uploaded_file)
-                            doc_content = "".join(p.extract_text() for p in reader.pages)
+                            doc_content = extract_pdf_text(uploaded_file.getvalue())
                         else:
                             doc_content = StringIO(uploaded_file.getvalue().decode("utf-8")).read()
                     except Exception as e:
@@ -100,13 +178,14 @@ def show_chatbot_page():
             if st.button("Generate Document", type="primary"):
                 st.session_state.scores = scores
                 with st.spinner("🤖 Assembling your final document..."):
-                    final_doc = finalize_requirements_document(st.session_state.requirements, scores)
+                    final_doc = asyncio.run(_crew_logic().finalize_requirements_document_async(st.session_state.requirements, scores))
                     st.session_state.final_doc = final_doc
                     st.session_state.stage = "final_document"
                     st.session_state.messages.append({"role": "assistant", "content": final_doc})
-                    update_current_chat_in_history()
+                    st.session_state.dirty = True
                     st.rerun()
 
+    # Kept at page level so the input stays pinned to the bottom of the page.
     if st.session_state.stage == "clarification":
         if prompt := st.chat_input("Your answer..."):
             handle_clarification_answer(prompt)
@@ -120,7 +199,7 @@ def show_chatbot_page():
         if col2.button("🔄 Update Requirements", use_container_width=True):
             st.session_state.stage = "initial"
             st.session_state.messages.append({"role": "assistant", "content": "Of course! Please describe the changes below."})
-            update_current_chat_in_history()
+            st.session_state.dirty = True
             st.rerun()
 
 # --- Logic Handler Functions ---
@@ -129,19 +208,23 @@ def show_chatbot_page():
 def handle_initial_request(user_input):
     # If there is no active chat ID, this is a brand new project. Create a new ID.
     if st.session_state.current_chat_id is None:
-        st.session_state.current_chat_id = time.time()
+        st.session_state.current_chat_id = uuid.uuid4().hex
         st.session_state.messages = [{"role": "user", "content": "Here is my project idea."}]
     else:
         # This is an existing chat being updated. We preserve the ID and append to messages.
         st.session_state.messages.append({"role": "user", "content": "Here are my updates."})
 
-    with st.spinner("🤖 Analyzing your request..."):
+    with st.chat_message("assistant"):
         try:
             # The AI logic for analysis is the same for new projects and updates.
-            result = json.loads(analyze_initial_request(user_input))
+            # Tokens are shown as they arrive instead of blocking until the full JSON is ready.
+            # Large uploads are cut to the model's context budget before anything is sent.
+            user_input = _crew_logic().trim_to_token_budget(user_input)
+            result = loads(st.write_stream(_crew_logic().stream_analyze(user_input)))
             st.session_state.requirements = result.get("initial_requirements", [])
             st.session_state.clarification_questions = result.get("clarifying_questions", [])
             st.session_state.question_index = 0
+            st.session_state.collected_answers = []
             st.session_state.stage = "clarification"
             if st.session_state.clarification_questions:
                 q = st.session_state.clarification_questions[0]
@@ -152,28 +235,33 @@ def handle_initial_request(user_input):
         except Exception as e:
             st.error(f"Sorry, an error occurred during analysis. Please try again. Error: {e}")
     
-    # Save the changes to the project (either new or existing)
-    update_current_chat_in_history()
+    # Mark the project (either new or existing) for saving at the end of this run
+    st.session_state.dirty = True
 
 def handle_clarification_answer(user_answer):
     st.session_state.messages.append({"role": "user", "content": user_answer})
     q_index = st.session_state.question_index
     current_q = st.session_state.clarification_questions[q_index]
-    with st.spinner("Thinking..."):
-        try:
-            result = json.loads(refine_requirements_with_answer(st.session_state.requirements, current_q, user_answer))
-            st.session_state.requirements = result.get("updated_requirements", st.session_state.requirements)
-            st.session_state.question_index += 1
-            if st.session_state.question_index < len(st.session_state.clarification_questions):
-                next_q = st.session_state.clarification_questions[st.session_state.question_index]
-                st.session_state.messages.append({"role": "assistant", "content": f"Got it. Next:\n\n*{st.session_state.question_index + 1}. {next_q}*"})
-            else:
+    # Answers are collected locally; the requirements are refined once, after the last question.
+    st.session_state.collected_answers.append({"question": current_q, "answer": user_answer})
+    st.session_state.question_index += 1
+    if st.session_state.question_index < len(st.session_state.clarification_questions):
+        next_q = st.session_state.clarification_questions[st.session_state.question_index]
+        st.session_state.messages.append({"role": "assistant", "content": f"Got it. Next:\n\n*{st.session_state.question_index + 1}. {next_q}*"})
+    else:
+        with st.spinner("Thinking..."):
+            try:
+                result = loads(asyncio.run(_crew_logic().refine_requirements_batch_async(st.session_state.requirements, st.session_state.collected_answers)))
+                st.session_state.requirements = result.get("updated_requirements", st.session_state.requirements)
                 req_list = "\n".join([f"- {req}" for req in st.session_state.requirements])
                 st.session_state.messages.append({"role": "assistant", "content": f"Great, that's everything! Here's the consolidated list:\n\n{req_list}\n\nNow, let's prioritize."})
                 st.session_state.stage = "prioritization"
-        except Exception as e:
-            st.error(f"Sorry, an error occurred while processing your answer. Error: {e}")
-    update_current_chat_in_history()
+            except Exception as e:
+                # Keep the last question open so the answer can be resubmitted.
+                st.session_state.collected_answers.pop()
+                st.session_state.question_index -= 1
+                st.error(f"Sorry, an error occurred while processing your answer. Error: {e}")
+    st.session_state.dirty = True
 
 # --- Session History Management Functions ---
 
@@ -188,54 +276,90 @@ def update_current_chat_in_history():
             'final_doc': st.session_state.final_doc, 'stage': st.session_state.stage,
             'clarification_questions': st.session_state.clarification_questions,
             'question_index': st.session_state.question_index,
+            'collected_answers': st.session_state.collected_answers,
             'prioritization_scores': st.session_state.scores
         }
-        chat_index = next((i for i, chat in enumerate(st.session_state.chat_history) if chat["id"] == chat_data['id']), -1)
-        if chat_index != -1:
-            st.session_state.chat_history[chat_index] = chat_data
+        # Only messages added since the last save are written; the transcript file is append-only.
+        new_messages = st.session_state.messages[st.session_state.persisted_messages:]
+        try:
+            persistence.save_session(st.session_state.workspace_id, chat_data, new_messages)
+        except OSError as e:
+            # The chat stays usable in memory; unsaved messages are retried on the next save.
+            st.warning(f"Couldn't save this project to disk: {e}")
         else:
-            st.session_state.chat_history.insert(0, chat_data)
+            st.session_state.persisted_messages = len(st.session_state.messages)
+        chat_data['persisted_messages'] = st.session_state.persisted_messages
+        chat_history = st.session_state.chat_history
+        chat_history[chat_data['id']] = chat_data
+        chat_history.move_to_end(chat_data['id'], last=False)
+        while len(chat_history) > MAX_CHAT_HISTORY:
+            chat_history.popitem(last=True)
+
+def save_current_chat_if_dirty():
+    if st.session_state.dirty:
+        update_current_chat_in_history()
+        st.session_state.dirty = False
 
 def start_new_chat():
     # We save the state of the old chat before wiping the slate clean for the new one.
-    update_current_chat_in_history()
+    save_current_chat_if_dirty()
     st.session_state.stage = "initial"
     st.session_state.messages = []
     st.session_state.requirements = []
     st.session_state.current_chat_id = None
     st.session_state.clarification_questions = []
     st.session_state.question_index = 0
+    st.session_state.collected_answers = []
     st.session_state.scores = {}
     st.session_state.final_doc = None
+    st.session_state.persisted_messages = 0
     st.rerun()
 
 def load_chat(chat_id):
-    update_current_chat_in_history()
-    chat_to_load = next((chat for chat in st.session_state.chat_history if chat["id"] == chat_id), None)
+    save_current_chat_if_dirty()
+    chat_to_load = st.session_state.chat_history.get(chat_id)
     if chat_to_load:
         for key, value in chat_to_load.items():
             st.session_state[key] = value
+        st.session_state.current_chat_id = chat_id
     # No rerun here, it's handled by the button click logic.
 
 # --- Main App Controller ---
 
+def _history_button(chat):
+    if st.button(chat["title"], key=f"load_{chat['id']}"):
+        load_chat(chat['id'])
+        st.rerun()
+
+@st.fragment
+def _render_history():
+    chats = list(st.session_state.chat_history.values())
+    for chat in chats[:RECENT_CHATS_IN_SIDEBAR]:
+        _history_button(chat)
+    older_chats = chats[RECENT_CHATS_IN_SIDEBAR:]
+    # A toggle rather than an expander: expander contents are sent to the browser even while collapsed.
+    if older_chats and st.toggle(f"Show {len(older_chats)} older chats", key="show_older_chats"):
+        for chat in older_chats:
+            _history_button(chat)
+
 def main():
-    with st.sidebar:
-        st.title("Menu")
-        st.session_state.page = st.radio("Navigation", ["Chatbot", "Dashboard"], label_visibility="collapsed")
-        if st.session_state.page == "Chatbot":
-            if st.button("➕ New Conversation", type="primary"):
-                start_new_chat()
-            st.markdown("### Chat History (This Session)")
-            for chat in st.session_state.chat_history:
-                if st.button(chat["title"], key=f"load_{chat['id']}"):
-                    load_chat(chat['id'])
-                    st.rerun()
+    try:
+        with st.sidebar:
+            st.title("Menu")
+            st.session_state.page = st.radio("Navigation", ["Chatbot", "Dashboard"], label_visibility="collapsed")
+            if st.session_state.page == "Chatbot":
+                if st.button("➕ New Conversation", type="primary"):
+                    start_new_chat()
+                st.markdown("### Chat History (This Workspace)")
+                _render_history()
 
-    if st.session_state.page == "Dashboard":
-        show_dashboard_page()
-    else:
-        show_chatbot_page()
+        if st.session_state.page == "Dashboard":
+            show_dashboard_page()
+        else:
+            show_chatbot_page()
+    finally:
+        # Runs even when a handler calls st.rerun(), which stops the script by raising.
+        save_current_chat_if_dirty()
 
 # --- App Entry Point ---
 if __name__ == "__main__":
@@ -1,8 +1,12 @@
 import os
-import json
+from json_utils import loads, dumps
+import asyncio
+import hashlib
+import functools
+import threading
+from diskcache import Cache
 from textwrap import dedent
 from crewai import Agent, Task, Crew, Process
-from langchain_community.chat_models import ChatLiteLLM
 
 # --- API Key & LLM Setup ---
 try:
@@ -15,10 +19,17 @@ except ImportError:
 if "GROQ_API_KEY" not in os.environ or not os.environ["GROQ_API_KEY"]:
     raise ValueError("GROQ_API_KEY is not set. Please add it to your environment variables or Streamlit secrets.")
 
-llm = ChatLiteLLM(
-    model="groq/llama-3.1-8b-instant",
-    temperature=0.1,
-)
+LLM_MODEL = "groq/llama-3.1-8b-instant"
+LLM_TEMPERATURE = 0.1
+
+@functools.lru_cache(maxsize=1)
+def get_llm():
+    # langchain_community is heavy to import, so the client is only built when the first agent needs it.
+    from langchain_community.chat_models import ChatLiteLLM
+    return ChatLiteLLM(
+        model=LLM_MODEL,
+        temperature=LLM_TEMPERATURE,
+    )
 
 # --- NEW: Business Rules Definition ---
 # These are the strategic goals the validator will check against.
@@ -39,126 +50,169 @@ business_rules = {
     }
 }
 
+# The rules are static, so they are serialized for prompts exactly once.
+_BUSINESS_RULES_JSON = dumps(business_rules, indent=True)
+
 
 # --- AGENTS ---
+# Agents are built on first use so importing this module does not construct the LLM client.
+
+# The analyst's persona is also sent directly by stream_analyze, which bypasses CrewAI.
+ANALYST_ROLE = "Strategic Product Lead"
+ANALYST_GOAL = "Quickly identify the 3-4 most critical, high-level questions needed to understand a new project idea."
+ANALYST_BACKSTORY = dedent("""
+    You are a seasoned product executive who thinks in terms of strategy, not minor features.
+    Your talent is cutting through the noise to find the key questions that define a project's soul.
+    """)
 
-strategic_analyst = Agent(
-    role="Strategic Product Lead",
-    goal="Quickly identify the 3-4 most critical, high-level questions needed to understand a new project idea.",
-    backstory=dedent("""
-        You are a seasoned product executive who thinks in terms of strategy, not minor features.
-        Your talent is cutting through the noise to find the key questions that define a project's soul.
-        """),
-    llm=llm,
-    verbose=False,
-    allow_delegation=False
-)
-
-refinement_specialist = Agent(
-    role="Requirements Refinement Specialist",
-    goal="Update a list of requirements based on a user's answer to a specific question.",
-    backstory=dedent("""
-        You are a meticulous analyst. You are given a list of requirements, one question, and one answer.
-        Your only job is to logically integrate the answer into the requirements list.
-        """),
-    llm=llm,
-    verbose=False,
-    allow_delegation=False
-)
+@functools.lru_cache(maxsize=1)
+def strategic_analyst():
+    return Agent(
+        role=ANALYST_ROLE,
+        goal=ANALYST_GOAL,
+        backstory=ANALYST_BACKSTORY,
+        llm=get_llm(),
+        verbose=False,
+        allow_delegation=False
+    )
+
+@functools.lru_cache(maxsize=1)
+def refinement_specialist():
+    return Agent(
+        role="Requirements Refinement Specialist",
+        goal="Update a list of requirements based on a user's answers to a set of clarifying questions.",
+        backstory=dedent("""
+            You are a meticulous analyst. You are given a list of requirements and several questions, each with the user's answer.
+            Your only job is to logically integrate all of the answers into the requirements list.
+            """),
+        llm=get_llm(),
+        verbose=False,
+        allow_delegation=False
+    )
 
 # NEW: Re-introducing the Business Validator Agent
-business_validator = Agent(
-    role="Business Logic & Strategy Expert",
-    goal=f"Validate a list of proposed software requirements against a strict set of business rules. Identify any conflicts, premium feature suggestions, or out-of-scope items.",
-    backstory=dedent(f"""
-        You are the guardian of the product strategy. You have a deep understanding of the business goals, encoded in the rules below. 
-        Your job is to meticulously review every proposed requirement and flag anything that doesn't align, suggesting how it could be changed or noting it as a premium feature.
-        Your output is a clear, validated list of requirements with annotations.
-
-        *Business Rules:*
-        {json.dumps(business_rules, indent=2)}
-        """),
-    llm=llm,
-    verbose=False
-)
-
-
-prioritizer_agent = Agent(
-    role="Product Manager",
-    goal="Analyze prioritization scores and provide a balanced, prioritized list with rationale.",
-    backstory="You are a master of prioritization, deciding what gets built first.",
-    llm=llm,
-    verbose=False
-)
-
-summarizer_agent = Agent(
-    role="Lead Technical Writer",
-    goal="Create a professional and structured Software Requirements Specification (SRS) document from a list of prioritized requirements.",
-    backstory="You are a highly skilled technical writer who crafts comprehensive, clear, and professional documentation.",
-    llm=llm,
-    verbose=False
-)
+@functools.lru_cache(maxsize=1)
+def business_validator():
+    return Agent(
+        role="Business Logic & Strategy Expert",
+        goal=f"Validate a list of proposed software requirements against a strict set of business rules. Identify any conflicts, premium feature suggestions, or out-of-scope items.",
+        backstory=dedent(f"""
+            You are the guardian of the product strategy. You have a deep understanding of the business goals, encoded in the rules below. 
+            Your job is to meticulously review every proposed requirement and flag anything that doesn't align, suggesting how it could be changed or noting it as a premium feature.
+            Your output is a clear, validated list of requirements with annotations.
+
+            *Business Rules:*
+            {_BUSINESS_RULES_JSON}
+            """),
+        llm=get_llm(),
+        verbose=False
+    )
 
-# --- CREW LOGIC FUNCTIONS ---
 
-def analyze_initial_request(initial_request: str) -> str:
-    # This function is unchanged.
-    analysis_task = Task(
-        description=f"""
+@functools.lru_cache(maxsize=1)
+def prioritizer_agent():
+    return Agent(
+        role="Product Manager",
+        goal="Analyze prioritization scores and provide a balanced, prioritized list with rationale.",
+        backstory="You are a master of prioritization, deciding what gets built first.",
+        llm=get_llm(),
+        verbose=False
+    )
+
+@functools.lru_cache(maxsize=1)
+def summarizer_agent():
+    return Agent(
+        role="Lead Technical Writer",
+        goal="Create a professional and structured Software Requirements Specification (SRS) document from a list of prioritized requirements.",
+        backstory="You are a highly skilled technical writer who crafts comprehensive, clear, and professional documentation.",
+        llm=get_llm(),
+        verbose=False
+    )
+
+# --- ASYNC EXECUTION HELPERS ---
+
+# Caps concurrent LLM round-trips across all sessions so parallel crews stay within Groq rate limits.
+# A thread semaphore is used because every asyncio.run() and st.write_stream call runs on its own event loop.
+MAX_CONCURRENT_LLM_CALLS = 4
+_llm_slots = threading.BoundedSemaphore(MAX_CONCURRENT_LLM_CALLS)
+
+# --- LLM RESPONSE CACHE ---
+
+# Identical prompts (e.g. Streamlit reruns, resubmitted text) are answered from disk instead of Groq.
+LLM_CACHE_TTL_SECONDS = 24 * 60 * 60
+_llm_cache = Cache(os.path.expanduser("~/.fintrack_cache"))
+
+def _prompt_cache_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode()).hexdigest()
+
+def _crew_cache_key(crew: Crew, inputs: dict) -> str:
+    # Computed before kickoff, while each task description is still the unfilled template.
+    templates = "".join(task.description + task.agent.role for task in crew.tasks)
+    return _prompt_cache_key(templates + dumps(inputs))
+
+def _is_cacheable(result: str, expect_json: bool) -> bool:
+    # Empty or malformed responses are not stored, so retrying the same input reaches the LLM again.
+    if not result.strip():
+        return False
+    if not expect_json:
+        return True
+    try:
+        return isinstance(loads(result), dict)
+    except ValueError:
+        return False
+
+def llm_cache(run):
+    @functools.wraps(run)
+    async def wrapper(crew: Crew, *, expect_json: bool = False, **inputs) -> str:
+        key = _crew_cache_key(crew, inputs)
+        cached = _llm_cache.get(key)
+        if cached is not None:
+            return cached
+        result = await run(crew, **inputs)
+        if _is_cacheable(result, expect_json):
+            _llm_cache.set(key, result, expire=LLM_CACHE_TTL_SECONDS)
+        return result
+    return wrapper
+
+# --- TASK TEMPLATES ---
+# Placeholders in braces are filled in by CrewAI from the inputs passed to kickoff().
+
+ANALYSIS_DESCRIPTION = """
             Analyze the following user request. Extract a preliminary list of requirements and generate a list of the 3-4 most critical, high-level questions.
             User Request: --- {initial_request} ---
             You MUST respond with a single, valid JSON object with keys 'initial_requirements' and 'clarifying_questions'.
-        """,
-        agent=strategic_analyst,
-        expected_output="A single valid JSON object."
-    )
-    crew = Crew(agents=[strategic_analyst], tasks=[analysis_task], process=Process.sequential)
-    return str(crew.kickoff())
-
-def refine_requirements_with_answer(current_requirements: list, question: str, answer: str) -> str:
-    # This function is unchanged.
-    refinement_task = Task(
-        description=f"""
-            A user was asked: "{question}". They answered: "{answer}".
-            Update the current requirements list based on their answer: {json.dumps(current_requirements)}.
+        """
+
+BATCH_REFINEMENT_DESCRIPTION = """
+            A user answered the following clarifying questions:
+            {answers}
+            Update the current requirements list based on all of their answers: {current_requirements}.
             You MUST respond with a single, valid JSON object with a single key: 'updated_requirements'.
-        """,
-        agent=refinement_specialist,
-        expected_output="A single valid JSON object."
-    )
-    crew = Crew(agents=[refinement_specialist], tasks=[refinement_task], process=Process.sequential)
-    return str(crew.kickoff())
-
-# UPDATED: This function now includes the validation step.
-def finalize_requirements_document(final_requirements: list, prioritization_scores: dict) -> str:
-    # NEW: A validation task that runs before prioritization.
-    validate_task = Task(
-        description=f"""
+        """
+
+VALIDATION_DESCRIPTION = """
             Review the following list of software requirements. Cross-reference each item against the business rules provided in your goal.
             Your output should be a revised list of requirements, with annotations added in parentheses for any item that is a premium feature, out of scope, or needs modification.
 
             Requirements to Validate:
-            {json.dumps(final_requirements, indent=2)}
-        """,
-        agent=business_validator,
-        expected_output="A revised list of requirements with validation annotations."
-    )
+            {final_requirements}
+        """
 
-    prioritize_task = Task(
-        description=f"""
-            Analyze the user's prioritization scores for the validated requirements and create a final, ranked list.
+PRIORITIZATION_DESCRIPTION = """
+            Analyze the user's prioritization scores for the requirements and create a final, ranked list.
             Provide a brief justification for each priority level (Critical, High, Medium).
 
-            Scores: {json.dumps(prioritization_scores, indent=2)}
-        """,
-        agent=prioritizer_agent,
-        context=[validate_task], # This task now depends on the output of the validation task.
-        expected_output="A prioritized list of requirements with justifications."
-    )
+            Scores: {prioritization_scores}
+        """
 
-    summarize_task = Task(
-        description=f"""
+SUMMARY_DESCRIPTION = """
             Generate a professional Software Requirements Specification (SRS) document in Markdown format based on the prioritized list of requirements.
+
+            Validation Results:
+            {validated}
+
+            Prioritized Requirements:
+            {prioritized}
             
             # UPDATED: The template now includes a Validation Summary section.
             You MUST follow this template exactly:
@@ -169,7 +223,7 @@ def finalize_requirements_document(final_requirements: list, prioritization_scor
             (Write a brief, 1-2 paragraph executive summary of the project based on the requirements.)
 
             ## 2. Validation Summary
-            (Based on the context from the validation task, briefly summarize how the requirements align with the business rules. Note any features that were flagged as Premium or out of scope.)
+            (Based on the validation results above, briefly summarize how the requirements align with the business rules. Note any features that were flagged as Premium or out of scope.)
 
             ## 3. Functional Requirements
             (List the functional requirements here, grouped by their priority.)
@@ -185,16 +239,97 @@ def finalize_requirements_document(final_requirements: list, prioritization_scor
             
             ## 4. Conclusion & Next Steps
             (Write a brief concluding paragraph.)
-        """,
-        agent=summarizer_agent,
-        context=[prioritize_task],
-        expected_output="A complete and professionally formatted SRS markdown document."
-    )
+        """
+
+# --- CREWS ---
+# A fresh crew is built per call from the shared agents and the templates above. CrewAI keeps run state on
+# its tasks (kickoff overwrites each description with the filled-in prompt), so one crew can't be safely
+# shared between concurrent sessions, and Crew.copy() would rebuild everything anyway.
+
+def _single_task_crew(agent: Agent, description: str, expected_output: str) -> Crew:
+    task = Task(description=description, agent=agent, expected_output=expected_output)
+    return Crew(agents=[agent], tasks=[task], process=Process.sequential)
+
+def _batch_refinement_crew():
+    return _single_task_crew(refinement_specialist(), BATCH_REFINEMENT_DESCRIPTION, "A single valid JSON object.")
+
+def _validation_crew():
+    return _single_task_crew(business_validator(), VALIDATION_DESCRIPTION, "A revised list of requirements with validation annotations.")
+
+def _prioritization_crew():
+    return _single_task_crew(prioritizer_agent(), PRIORITIZATION_DESCRIPTION, "A prioritized list of requirements with justifications.")
+
+def _summary_crew():
+    return _single_task_crew(summarizer_agent(), SUMMARY_DESCRIPTION, "A complete and professionally formatted SRS markdown document.")
+
+def _kickoff(crew: Crew, inputs: dict) -> str:
+    with _llm_slots:
+        return str(crew.kickoff(inputs=inputs))
+
+@llm_cache
+async def _run(crew: Crew, **inputs) -> str:
+    return await asyncio.to_thread(_kickoff, crew, inputs)
+
+# --- PROMPT SIZE LIMITS ---
+
+# Leaves headroom in the model's 8k context for the task template and the response.
+MAX_PROMPT_TOKENS = 6000
+
+@functools.lru_cache(maxsize=1)
+def _token_encoding():
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base")
+
+def trim_to_token_budget(text: str, max_tokens: int = MAX_PROMPT_TOKENS, keep_tail: bool = False) -> str:
+    """
+    Truncates text to at most `max_tokens` tokens, keeping the start (or the end when `keep_tail` is set).
+    """
+    encoding = _token_encoding()
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[-max_tokens:] if keep_tail else tokens[:max_tokens])
+
+# --- CREW LOGIC FUNCTIONS ---
+
+async def stream_analyze(initial_request: str):
+    # Sends the analysis prompt straight to LiteLLM and yields tokens as Groq produces them.
+    import litellm
+    prompt = ANALYSIS_DESCRIPTION.format(initial_request=initial_request)
+    key = _prompt_cache_key(prompt + ANALYST_ROLE)
+    cached = _llm_cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    messages = [
+        {"role": "system", "content": f"You are a {ANALYST_ROLE}. {ANALYST_GOAL}\n{ANALYST_BACKSTORY}"},
+        {"role": "user", "content": prompt},
+    ]
+    chunks = []
+    await asyncio.to_thread(_llm_slots.acquire)
+    try:
+        response = await litellm.acompletion(model=LLM_MODEL, messages=messages, temperature=LLM_TEMPERATURE, stream=True)
+        async for chunk in response:
+            token = chunk.choices[0].delta.content
+            if token:
+                chunks.append(token)
+                yield token
+    finally:
+        _llm_slots.release()
+    result = "".join(chunks)
+    if _is_cacheable(result, expect_json=True):
+        _llm_cache.set(key, result, expire=LLM_CACHE_TTL_SECONDS)
+
+async def refine_requirements_batch_async(current_requirements: list, answers: list) -> str:
+    # One round-trip for every collected answer instead of one per question.
+    answers_text = "\n".join(f'- Asked: "{item["question"]}". Answered: "{item["answer"]}".' for item in answers)
+    return await _run(_batch_refinement_crew(), expect_json=True, answers=answers_text, current_requirements=trim_to_token_budget(dumps(current_requirements), keep_tail=True))
 
-    # UPDATED: The crew now includes the business_validator agent.
-    project_crew = Crew(
-        agents=[business_validator, prioritizer_agent, summarizer_agent],
-        tasks=[validate_task, prioritize_task, summarize_task],
-        process=Process.sequential
+async def finalize_requirements_document_async(final_requirements: list, prioritization_scores: dict) -> str:
+    # Validation and prioritization only read the user's inputs, so they run concurrently.
+    validated, prioritized = await asyncio.gather(
+        _run(_validation_crew(), final_requirements=dumps(final_requirements, indent=True)),
+        _run(_prioritization_crew(), prioritization_scores=dumps(prioritization_scores, indent=True)),
     )
-    return str(project_crew.kickoff())
\ No newline at end of file
+    return await _run(_summary_crew(), validated=validated, prioritized=prioritized)
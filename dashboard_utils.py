@@ -1,5 +1,8 @@
+import numpy as np
 import pandas as pd
 
+PRIORITY_LEVELS = ['Critical', 'High', 'Medium']
+
 def get_dashboard_data(chats: list) -> dict:
     """
     Processes a list of chat histories and returns a dictionary of dashboard stats.
@@ -14,31 +17,27 @@ def get_dashboard_data(chats: list) -> dict:
         }
 
     total_projects = len(chats)
-    total_requirements = 0
-    priority_distribution = {'Critical': 0, 'High': 0, 'Medium': 0}
+    total_requirements = sum(len(chat.get('requirements', [])) for chat in chats)
 
-    for chat in chats:
-        requirements = chat.get('requirements', [])
-        total_requirements += len(requirements)
-        
-        scores = chat.get('prioritization_scores', {})
-        if scores:
-            for req in requirements:
-                score = scores.get(req, 0)
-                if score >= 8:
-                    priority_distribution['Critical'] += 1
-                elif score >= 5:
-                    priority_distribution['High'] += 1
-                else:
-                    priority_distribution['Medium'] += 1
+    # Only prioritized projects contribute scores; binning happens in a single pandas pass.
+    scores = pd.Series([
+        chat['prioritization_scores'].get(req, 0)
+        for chat in chats if chat.get('prioritization_scores')
+        for req in chat.get('requirements', [])
+    ], dtype=float)
+    priority_distribution = (
+        pd.cut(scores, bins=[-np.inf, 5, 8, np.inf], right=False, labels=['Medium', 'High', 'Critical'])
+        .value_counts()
+        .reindex(PRIORITY_LEVELS, fill_value=0)
+    )
 
     avg_requirements = round(total_requirements / total_projects, 1) if total_projects > 0 else 0
     
     # Prepare data for charting
-    priority_df = pd.DataFrame(list(priority_distribution.items()), columns=['Priority', 'Count'])
+    priority_df = priority_distribution.rename_axis('Priority').reset_index(name='Count')
 
-    # Get the 5 most recent projects for the table
-    recent_projects = sorted(chats, key=lambda x: x.get('id', 0), reverse=True)[:5]
+    # Chats arrive most recent first, so the first 5 are the most recent projects
+    recent_projects = list(chats[:5])
     
     return {
         "total_projects": total_projects,
@@ -0,0 +1,10 @@
+import orjson
+
+# orjson is several times faster than the stdlib json module on LLM-sized payloads.
+loads = orjson.loads
+
+def dumps(obj, indent: bool = False) -> str:
+    """
+    Serializes an object to a JSON string, optionally pretty-printed with 2-space indentation.
+    """
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode()
@@ -0,0 +1,116 @@
+import os
+import re
+import time
+import logging
+from json_utils import loads, dumps
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock; the atomic rename alone still prevents torn metadata files.
+    fcntl = None
+
+# Projects are grouped per workspace so one visitor never sees another's projects.
+WORKSPACES_DIR = os.path.expanduser("~/.fintrack/workspaces")
+_WORKSPACE_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+logger = logging.getLogger(__name__)
+
+# Everything about a project except its transcript, which is stored separately as JSONL.
+METADATA_FIELDS = (
+    'id', 'title', 'stage', 'requirements', 'final_doc',
+    'clarification_questions', 'question_index', 'collected_answers', 'prioritization_scores'
+)
+
+def is_valid_workspace_id(workspace_id: str) -> bool:
+    return bool(_WORKSPACE_ID_PATTERN.fullmatch(workspace_id))
+
+def _projects_dir(workspace_id: str) -> str:
+    # The id ends up in a filesystem path, so anything but a uuid4 hex string is rejected.
+    if not is_valid_workspace_id(workspace_id):
+        raise ValueError(f"Invalid workspace id: {workspace_id!r}")
+    return os.path.join(WORKSPACES_DIR, workspace_id, "projects")
+
+def _project_dir(workspace_id: str, chat_id) -> str:
+    path = os.path.join(_projects_dir(workspace_id), str(chat_id))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+@contextmanager
+def _file_lock(path: str):
+    with open(path + ".lock", "w") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def append_transcript(workspace_id: str, chat_id, messages: list) -> None:
+    """
+    Appends new chat messages to the project's transcript, one JSON object per line.
+    """
+    if not messages:
+        return
+    path = os.path.join(_project_dir(workspace_id, chat_id), "transcript.jsonl")
+    with open(path, "a", encoding="utf-8") as transcript:
+        transcript.writelines(dumps(message) + "\n" for message in messages)
+
+def write_metadata(workspace_id: str, chat_id, chat_data: dict) -> None:
+    """
+    Atomically replaces the project's metadata file with the current chat state.
+    """
+    path = os.path.join(_project_dir(workspace_id, chat_id), "metadata.json")
+    tmp_path = path + ".tmp"
+    metadata = {field: chat_data.get(field) for field in METADATA_FIELDS}
+    metadata['updated_at'] = time.time()
+    with _file_lock(path):
+        with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+            tmp_file.write(dumps(metadata))
+        os.replace(tmp_path, path)
+
+def save_session(workspace_id: str, chat_data: dict, new_messages: list) -> None:
+    """
+    Persists a project: appends its new messages to the transcript and rewrites its metadata.
+    """
+    # Metadata is rewritten first: if the append then fails, retrying the save never duplicates transcript lines.
+    write_metadata(workspace_id, chat_data['id'], chat_data)
+    append_transcript(workspace_id, chat_data['id'], new_messages)
+
+def load_sessions(workspace_id: str, limit: int) -> list:
+    """
+    Loads a workspace's most recently updated projects from disk, newest first, so a restarted app resumes without new LLM calls.
+    """
+    projects_dir = _projects_dir(workspace_id)
+    if not os.path.isdir(projects_dir):
+        return []
+
+    projects = []
+    for entry in os.scandir(projects_dir):
+        metadata_path = os.path.join(entry.path, "metadata.json")
+        if entry.is_dir() and os.path.exists(metadata_path):
+            with open(metadata_path, "rb") as metadata_file:
+                try:
+                    projects.append((loads(metadata_file.read()), entry.path))
+                except ValueError:
+                    logger.warning("Skipping project with unreadable metadata: %s", metadata_path)
+    projects.sort(key=lambda project: project[0].get('updated_at', 0), reverse=True)
+
+    chats = []
+    for metadata, path in projects[:limit]:
+        transcript_path = os.path.join(path, "transcript.jsonl")
+        messages = []
+        if os.path.exists(transcript_path):
+            with open(transcript_path, "rb") as transcript:
+                for line_number, line in enumerate(transcript, start=1):
+                    if not line.strip():
+                        continue
+                    # A crash mid-append leaves a truncated line; drop it rather than the whole project.
+                    try:
+                        messages.append(loads(line))
+                    except ValueError:
+                        logger.warning("Skipping unreadable line %d in %s", line_number, transcript_path)
+        chats.append({**metadata, 'messages': messages, 'persisted_messages': len(messages)})
+    return chats